@@ -3,97 +3,735 @@
 """Mirroring one directory to another directory.
 
 Script compares two directories (src and dst) and synchronizes them periodically.
-
-Warning: multiple nested directories can cause crash this script
-         due to recursion limit (maximum depth of stack) in Python interpreter.
-         If this happens, you can try to increase this limit (default 1000):
-         sys.setrecursionlimit(limit)
 """
 from __future__ import annotations
 
+import errno
 import logging
+import os
+import sqlite3
 from argparse import ArgumentParser, ArgumentTypeError, RawDescriptionHelpFormatter
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import suppress
 from filecmp import cmpfiles, dircmp
+from functools import partial
 from pathlib import Path
-from shutil import rmtree, copytree, copy2
-from sys import exit
-from time import sleep
+from shutil import SpecialFileError, copyfileobj, copystat
+from stat import S_IFDIR, S_IFREG, S_ISFIFO
+from sys import exit, platform
+from threading import Lock
+from time import monotonic, sleep, time_ns
+from typing import TYPE_CHECKING, BinaryIO
+
+from sync_periodical_fast import (
+    HASH_NAME,
+    cmp_signatures,
+    entry_type,
+    hash_file,
+    prefetch,
+    same_contents,
+    scan_dir,
+    stat_signature,
+)
+
+try:  # optional dependency - watch src directory for changes on linux
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+
+RACY_NS = 2_000_000_000  # inode changed in last 2 s is not cached, it may change again with the same timestamps
+
+
+class ListingCache:
+    """Cache of directory listings between syncs, listing is valid while times of both directories are unchanged.
+
+    Times are mtime_ns and ctime_ns (ctime can not be set by touch). Listings with symlinks are not cached
+    (DirEntry keeps the type of symlink target from its first stat, the target can change without change
+    of directory). Listings not used in last sync are dropped by next_sync.
+    """
+
+    def __init__(self) -> None:
+        """Create empty cache."""
+        self._previous: dict[tuple[str, str], tuple[tuple[int, ...], dict, dict]] = {}
+        self._current: dict[tuple[str, str], tuple[tuple[int, ...], dict, dict]] = {}
+
+    def get(self, left: str, right: str, times: tuple[int, ...]) -> tuple[dict, dict] | None:
+        """Return cached entries of left and right directory if their mtime_ns and ctime_ns are unchanged."""
+        cached = self._current.get((left, right)) or self._previous.get((left, right))
+        if not cached or cached[0] != times:
+            return None
+        self._current[left, right] = cached
+        return cached[1], cached[2]
+
+    def put(self, left: str, right: str, times: tuple[int, ...], left_entries: dict, right_entries: dict) -> None:
+        """Cache entries of left and right directory with their mtime_ns and ctime_ns (taken before scan)."""
+        if time_ns() - max(times) > RACY_NS and not any(
+                entry.is_symlink() for entries in (left_entries, right_entries) for entry in entries.values()):
+            self._current[left, right] = (times, left_entries, right_entries)
+
+    def next_sync(self) -> None:
+        """Start next sync, listings not used since previous call are dropped."""
+        self._previous, self._current = self._current, {}
+
+
+PREFETCH_FILES = 8  # pairs of files read ahead while comparing by contents
+
 
+class FastDirCmp(dircmp):
+    """Modified dircmp class to scan directories by os.scandir and compare files by statx signatures.
 
-class DirCmpByContents(dircmp):
-    """Modified dircmp class to compare two directories by contents (shallow=False) ... hack to python 3.10 - 3.12."""
+    File types are taken from directory listing (no stat per entry), files are compared by contents only
+    if they have the same size and different mtime (as shallow filecmp.cmp).
+    If listing_cache is set, unchanged directories are not scanned again (files are still compared).
+    """
+
+    listing_cache: ListingCache | None = None
+
+    def __init__(self, a: str, b: str, ignore: Iterable[str] = (), hide: Iterable[str] = (), *,
+                 top_ignore: Iterable[str] = (), **kwargs: bool) -> None:
+        """Modify init to keep ignore and hide as frozensets (no names ignored by default, unlike dircmp).
+
+        os.scandir never lists os.curdir and os.pardir, so they are not hidden. Frozensets are passed
+        to subdirectories as they are, so they are built once per tree. Names in top_ignore are ignored
+        only in this pair of directories, not in subdirectories.
+        """
+        super().__init__(a, b, frozenset(ignore), frozenset(hide), **kwargs)
+        self.skip = self.ignore | self.hide | frozenset(top_ignore) if self.hide or top_ignore else self.ignore
+
+    def phase0(self) -> None:  # Compare everything except common subdirectories
+        """Modify phase0 to list directories by os.scandir and keep their entries."""
+        if self.listing_cache is None:
+            self.left_entries = scan_dir(self.left, self.skip)
+            self.right_entries = scan_dir(self.right, self.skip)
+        else:
+            left_st, right_st = os.stat(self.left), os.stat(self.right)
+            times = left_st.st_mtime_ns, left_st.st_ctime_ns, right_st.st_mtime_ns, right_st.st_ctime_ns
+            cached = self.listing_cache.get(self.left, self.right, times)
+            if cached:
+                self.left_entries, self.right_entries = cached
+            else:
+                self.left_entries = scan_dir(self.left, self.skip)
+                self.right_entries = scan_dir(self.right, self.skip)
+                self.listing_cache.put(self.left, self.right, times, self.left_entries, self.right_entries)
+        self.left_list = sorted(self.left_entries)
+        self.right_list = sorted(self.right_entries)
+
+    def phase2(self) -> None:  # Distinguish files, directories, funnies
+        """Modify phase2 to distinguish common inodes by types of directory entries."""
+        self.common_dirs, self.common_files, self.common_funny = [], [], []
+        for x in self.common:
+            right_entry = self.right_entries.get(x)
+            if right_entry is None:  # name differs only by case (case-insensitive filesystem)
+                right_entry = next(entry for name, entry in self.right_entries.items()
+                                   if os.path.normcase(name) == os.path.normcase(x))
+            _type = entry_type(self.left_entries[x])
+            if not _type or _type != entry_type(right_entry):
+                self.common_funny.append(x)
+            elif _type == S_IFDIR:
+                self.common_dirs.append(x)
+            else:
+                self.common_files.append(x)
 
     def phase3(self) -> None:  # Find out differences between common files
-        """Modify phase3 to compare common files by contents (shallow=False) ... hack to python 3.10 - 3.12."""
-        xx = cmpfiles(self.left, self.right, self.common_files, shallow=False)
-        self.same_files, self.diff_files, self.funny_files = xx
+        """Modify phase3 to compare common files by statx signatures, by contents only if sizes are equal.
 
-    methodmap = dict(dircmp.methodmap, same_files=phase3, diff_files=phase3, funny_files=phase3)
+        Files compared by contents are read ahead PREFETCH_FILES pairs before their compare.
+        """
+        self.same_files, self.diff_files, self.funny_files = [], [], []
+        to_read = []
+        left, right = os.fsencode(self.left), os.fsencode(self.right)  # bytes paths are not encoded by each syscall
+        for x in self.common_files:
+            name = os.fsencode(x)
+            a_path = os.path.join(left, name)
+            b_path = os.path.join(right, name)
+            try:
+                a_sig = stat_signature(a_path)
+                same = cmp_signatures(a_sig, stat_signature(b_path))
+            except OSError:
+                self.funny_files.append(x)
+                continue
+            if same is None:
+                to_read.append((x, a_path, b_path, a_sig[1]))
+            else:
+                (self.same_files if same else self.diff_files).append(x)
+        for _, a_path, b_path, size in to_read[1:PREFETCH_FILES]:
+            prefetch(a_path, size)
+            prefetch(b_path, size)
+        for i, (x, a_path, b_path, size) in enumerate(to_read):
+            if i + PREFETCH_FILES < len(to_read):  # keep PREFETCH_FILES pairs read ahead
+                _, a_next, b_next, next_size = to_read[i + PREFETCH_FILES]
+                prefetch(a_next, next_size)
+                prefetch(b_next, next_size)
+            try:
+                same = same_contents(a_path, b_path, size)
+            except OSError:
+                self.funny_files.append(x)
+                continue
+            (self.same_files if same else self.diff_files).append(x)
 
+    def phase5(self) -> None:  # Find out if subtree has any differences
+        """Set dirty flag (differences in directory or any subdirectory) bottom-up in subtree (iteratively)."""
+        nodes, stack = [], [self]
+        while stack:  # pre-order, subtrees with known dirty flag are skipped
+            node = stack.pop()
+            if "dirty" not in node.__dict__:
+                nodes.append(node)
+                stack.extend(node.subdirs.values())
+        for node in reversed(nodes):  # subdirectories before their parents
+            node.dirty = bool(node.left_only or node.right_only or node.diff_files or node.funny_files
+                              or node.common_funny or any(subdir.dirty for subdir in node.subdirs.values()))
 
-DirCmp: type(dircmp) = dircmp  # DirCmp default compare files by shallow=True
+    methodmap = dict(dircmp.methodmap,
+                     left_list=phase0, right_list=phase0, left_entries=phase0, right_entries=phase0,
+                     common_dirs=phase2, common_files=phase2, common_funny=phase2,
+                     same_files=phase3, diff_files=phase3, funny_files=phase3, dirty=phase5)
 
 
-def remove_inodes(dst_dir: str, inodes: list[str]) -> None:
-    """Remove files and directories in inodes list from directory dst_dir."""
-    for inode in inodes:
+HASH_CACHE_NAME = ".sync_periodical_hashes.db"  # cache file in dst directory
+# names ignored in root of src and dst in every mode (cache is not removed by sync without -b), not in subdirectories
+HASH_CACHE_NAMES = frozenset({HASH_CACHE_NAME, HASH_CACHE_NAME + "-journal"})
+
+
+HASH_CACHE_VERSION = 2  # user_version of cache database, cache of other version is dropped
+
+
+class HashCache:
+    """Cache of file hashes in sqlite database, hash is valid while inode, size, mtime_ns and ctime_ns are unchanged.
+
+    ctime can not be set by touch (utime), so file rewritten with restored mtime is hashed again. Hashes of files
+    changed in last RACY_NS are not cached. Hashes of files not looked up since previous prune_unseen are removed by it.
+    """
+
+    def __init__(self, database: str) -> None:
+        """Open (create) cache database, database ":memory:" is not persisted."""
+        self._lock = Lock()
+        self._seen: set[str] = set()
+        self._db = sqlite3.connect(database, check_same_thread=False)
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != HASH_CACHE_VERSION:
+            self._db.execute("DROP TABLE IF EXISTS hashes")
+            self._db.execute(f"PRAGMA user_version = {HASH_CACHE_VERSION}")
+        self._db.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, "
+                         "ino INTEGER, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, hash TEXT)")
+
+    def file_hash(self, path: str, signature: tuple[int, int, int, int, int], *,
+                  cached_only: bool = False) -> str | None:
+        """Return hash of regular file contents from cache or compute it (signature is from stat_signature).
+
+        If cached_only, None is returned for file not in cache.
+        """
+        _, size, mtime_ns, ctime_ns, ino = signature
+        with self._lock:
+            self._seen.add(path)
+            row = self._db.execute("SELECT hash FROM hashes "
+                                   "WHERE path = ? AND ino = ? AND size = ? AND mtime_ns = ? AND ctime_ns = ?",
+                                   (path, ino, size, mtime_ns, ctime_ns)).fetchone()
+        if row and row[0].startswith(HASH_NAME + ":"):
+            return row[0]
+        if cached_only:
+            return None
+        _hash = hash_file(path)
+        if time_ns() - max(mtime_ns, ctime_ns) > RACY_NS:
+            with self._lock:
+                self._db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                                 (path, ino, size, mtime_ns, ctime_ns, _hash))
+        return _hash
+
+    def prune_unseen(self) -> None:
+        """Remove hashes of files not looked up since previous call (removed files or files with different sizes)."""
+        with self._lock:
+            self._db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)")
+            self._db.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((path,) for path in self._seen))
+            self._db.execute("DELETE FROM hashes WHERE path NOT IN (SELECT path FROM seen)")
+            self._db.execute("DELETE FROM seen")
+            self._seen.clear()
+
+    def discard(self, path: str) -> None:
+        """Remove file from cache (e.g. file will be rewritten, maybe with the same size and mtime)."""
+        with self._lock:
+            self._db.execute("DELETE FROM hashes WHERE path = ?", (path,))
+
+    def commit(self) -> None:
+        """Persist cached hashes."""
+        with self._lock:
+            self._db.commit()
+
+
+HASH_WORKERS = 8  # maximum of files hashed at once in whole process (threads of shared hash executor)
+
+
+class DirCmpByContents(FastDirCmp):
+    """Modified dircmp class to compare two directories by contents (shallow=False) ... hack to python 3.10 - 3.12.
+
+    Directories are scanned as in FastDirCmp. If hash_cache is set, files are compared by hashes of contents
+    (cached between syncs), files with different sizes are different without reading them, files not in cache
+    are hashed in threads of hash_executor (shared by all directories) if it is set.
+    """
+
+    hash_cache: HashCache | None = None
+    hash_executor: Executor | None = None
+
+    def cmp_by_hash(self, name: str, left_sig: tuple[int, int, int, int, int],
+                    right_sig: tuple[int, int, int, int, int], *, cached_only: bool = False) -> bool | OSError | None:
+        """Compare regular files name with the same size in left and right directory by hashes of contents.
+
+        Signatures are from stat_signature. Return None if cached_only and hashes are not cached, OSError is returned
+        (not raised).
+        """
+        left_path = os.path.join(self.left, name)
+        right_path = os.path.join(self.right, name)
         try:
-            path = Path(dst_dir, inode)
-            if path.is_dir():
-                logging.debug("--- Remove directory tree [%s]", str(path))
-                rmtree(path, ignore_errors=True)
+            left_hash = self.hash_cache.file_hash(left_path, left_sig, cached_only=cached_only)
+            right_hash = self.hash_cache.file_hash(right_path, right_sig, cached_only=cached_only)
+        except OSError as exc:
+            return exc
+        if left_hash is None or right_hash is None:
+            return None
+        return left_hash == right_hash
+
+    def add_result(self, name: str, *, same: bool | OSError) -> None:
+        """Add file name to same_files, diff_files or funny_files by result of comparison."""
+        if isinstance(same, OSError):
+            self.funny_files.append(name)
+        elif same:
+            self.same_files.append(name)
+        else:
+            self.diff_files.append(name)
+            self.hash_cache.discard(os.path.join(self.right, name))  # dst file will be rewritten
+
+    def phase3(self) -> None:  # Find out differences between common files
+        """Modify phase3 to compare common files by contents (shallow=False) ... hack to python 3.10 - 3.12."""
+        if self.hash_cache is None:
+            xx = cmpfiles(self.left, self.right, self.common_files, shallow=False)
+            self.same_files, self.diff_files, self.funny_files = xx
+            return
+        self.same_files, self.diff_files, self.funny_files = [], [], []
+        names, left_sigs, right_sigs = [], [], []  # files not in cache
+        for name in self.common_files:
+            try:
+                left_sig = stat_signature(os.path.join(self.left, name))
+                right_sig = stat_signature(os.path.join(self.right, name))
+            except OSError:
+                self.funny_files.append(name)
+                continue
+            if left_sig[0] != S_IFREG or right_sig[0] != S_IFREG or left_sig[1] != right_sig[1]:
+                self.add_result(name, same=False)
+                continue
+            same = self.cmp_by_hash(name, left_sig, right_sig, cached_only=True)
+            if same is None:
+                names.append(name)
+                left_sigs.append(left_sig)
+                right_sigs.append(right_sig)
             else:
-                logging.debug("--- Remove file '%s'", str(path))
-                path.unlink(missing_ok=True)  # ignore nonexistent files (rm -f)
-        except Exception:
-            logging.exception("--- Problem in directory [%s] with removing inode: '%s'", dst_dir, inode)
+                self.add_result(name, same=same)
+        _map = self.hash_executor.map if self.hash_executor and len(names) > 1 else map
+        for name, same in zip(names, _map(self.cmp_by_hash, names, left_sigs, right_sigs), strict=True):
+            self.add_result(name, same=same)
+
+    methodmap = dict(FastDirCmp.methodmap, same_files=phase3, diff_files=phase3, funny_files=phase3)
+
+
+DirCmp: type(FastDirCmp) = FastDirCmp  # DirCmp default compare files by shallow=True
+
+PARALLEL_SUBDIRS_MIN = 4  # mirror subtrees in parallel only for wider directory (small trees avoid threading overhead)
+
+
+KERNEL_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK}
+KERNEL_COPY = [copy_range for copy_range in (
+    getattr(os, "copy_file_range", None),  # linux: reflink/server-side copy on supporting filesystems
+    (lambda infd, outfd, count: os.sendfile(outfd, infd, None, count)) if hasattr(os, "sendfile") else None,
+) if copy_range]
+
 
+def copy_data(fsrc: BinaryIO, fdst: BinaryIO) -> None:
+    """Copy data between opened files in kernel (copy_file_range, then sendfile), fallback to read/write copy.
 
-def copy_inodes(src_dir: str, dst_dir: str, inodes: list[str], *, follow_symlinks: bool = False) -> None:
-    """Copy files and directories in inodes list from directory src_dir to directory dst_dir."""
+    Each fallback continues from current file offsets, so partially copied data is not copied again.
+    """
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    size = os.fstat(infd).st_size
+    count = min(max(size, 1 << 23), 1 << 30)  # 8 MiB - 1 GiB per call
+    copied = 0
+    for copy_range in KERNEL_COPY:
+        try:
+            while sent := copy_range(infd, outfd, count):
+                copied += sent
+        except OSError as exc:
+            if exc.errno not in KERNEL_COPY_FALLBACK_ERRNOS:
+                raise
+            continue
+        if copied or not size:  # 0 at start of nonempty file - filesystem does not support it
+            return
+    copyfileobj(fsrc, fdst)
+
+
+def fast_copy2(src: str, dst: str, *, follow_symlinks: bool = True) -> str:
+    """Copy file with metadata as shutil.copy2, but copy data in kernel by copy_data.
+
+    Named pipe (src or dst) is rejected by SpecialFileError as by shutil.copyfile, open of it would block.
+    """
+    for path in (src, dst):
+        with suppress(FileNotFoundError):  # dst does not exist yet
+            if S_ISFIFO(os.stat(path).st_mode):
+                msg = f"`{path}` is a named pipe"
+                raise SpecialFileError(msg)
+    if not follow_symlinks and os.path.islink(src):
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        os.symlink(os.readlink(src), dst)
+    else:
+        with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
+            copy_data(fsrc, fdst)
+    copystat(src, dst, follow_symlinks=follow_symlinks)
+    return dst
+
+
+def split_inodes(entries: dict[str, os.DirEntry], inodes: list[str], *,
+                 follow_symlinks: bool = True) -> tuple[list[str], list[str]]:
+    """Split inodes list to files and directories by their directory entries (no stat per inode)."""
+    file_inodes, dir_inodes = [], []
     for inode in inodes:
+        (dir_inodes if entries[inode].is_dir(follow_symlinks=follow_symlinks) else file_inodes).append(inode)
+    return file_inodes, dir_inodes
+
+
+def remove_file(dst_dir: str, inode: str) -> None:
+    """Remove file (or symlink) inode from directory dst_dir."""
+    path = os.path.join(dst_dir, inode)
+    try:
+        logging.debug("--- Remove file '%s'", path)
+        os.unlink(path)
+    except FileNotFoundError:  # ignore nonexistent files (rm -f)
+        pass
+    except Exception:
+        logging.exception("--- Problem in directory [%s] with removing inode: '%s'", dst_dir, inode)
+
+
+def fast_rmtree(path: str) -> None:
+    """Remove directory tree path (iterative os.scandir walk, symlinks are not followed).
+
+    Files are unlinked while walking top-down, directories are removed bottom-up. Only already missing inodes
+    are ignored, first other error is raised and stops removing of the whole tree (unlike rmtree with
+    ignore_errors=True, the rest of the tree is kept). Tree is walked with bytes paths, so they are not encoded
+    by each syscall.
+    """
+    dirs = [os.fsencode(path)]
+    for directory in dirs:  # dirs grows while walking
         try:
-            path = Path(src_dir, inode)
-            if path.is_dir():
-                logging.debug("--- Copy directory tree [%s] to [%s]", str(path), dst_dir)
-                copytree(path, Path(dst_dir, inode),
-                         symlinks=not follow_symlinks,
-                         ignore_dangling_symlinks=True,
-                         dirs_exist_ok=True)
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            continue
+        files = []
+        with entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except FileNotFoundError:  # removed after listing (lstat on filesystem without d_type)
+                    continue
+                (dirs if is_dir else files).append(entry.path)
+        for file in files:
+            with suppress(FileNotFoundError):
+                os.unlink(file)
+    for directory in reversed(dirs):
+        with suppress(FileNotFoundError):
+            os.rmdir(directory)
+
+
+def remove_dir(dst_dir: str, inode: str) -> None:
+    """Remove directory tree inode from directory dst_dir."""
+    path = os.path.join(dst_dir, inode)
+    try:
+        logging.debug("--- Remove directory tree [%s]", path)
+        fast_rmtree(path)
+    except Exception:
+        logging.exception("--- Problem in directory [%s] with removing inode: '%s'", dst_dir, inode)
+
+
+def remove_inodes(dst_dir: str, file_inodes: list[str], dir_inodes: list[str], *,
+                  executor: Executor | None = None) -> None:
+    """Remove files and directories in inodes lists from directory dst_dir (in parallel if executor is set)."""
+    _map = executor.map if executor else map
+    list(_map(partial(remove_file, dst_dir), file_inodes))
+    list(_map(partial(remove_dir, dst_dir), dir_inodes))
+
+
+def copy_file(src_dir: str, dst_dir: str, inode: str, *, follow_symlinks: bool = False) -> None:
+    """Copy file inode from directory src_dir to directory dst_dir."""
+    path = os.path.join(src_dir, inode)
+    try:
+        logging.debug("--- Copy file '%s' to [%s]", path, dst_dir)
+        fast_copy2(path, os.path.join(dst_dir, inode), follow_symlinks=follow_symlinks)
+    except Exception:
+        logging.exception("--- Problem with copying from directory [%s] to directory[%s] with inode: '%s'",
+                          src_dir, dst_dir, inode)
+
+
+def copy_dir_files(src_dir: str, dst_dir: str, *, follow_symlinks: bool = False,
+                   executor: Executor | None = None) -> tuple[list[tuple[str, str]], list[Future]]:
+    """Create directory dst_dir and copy files of directory src_dir to it (submitted to executor if set).
+
+    Return pairs of src and dst subdirectories to copy and futures of submitted files. Dangling symlinks (if symlinks
+    are followed) and special files are skipped with warning.
+    """
+    os.makedirs(dst_dir, exist_ok=True)
+    subdirs, futures, skipped = [], [], []
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                subdirs.append((entry.path, os.path.join(dst_dir, entry.name)))
+            elif entry.is_file() or (not follow_symlinks and entry.is_symlink()):
+                if executor:
+                    futures.append(executor.submit(copy_file, src_dir, dst_dir, entry.name,
+                                                   follow_symlinks=follow_symlinks))
+                else:
+                    copy_file(src_dir, dst_dir, entry.name, follow_symlinks=follow_symlinks)
             else:
-                logging.debug("--- Copy file '%s' to [%s]", str(path), dst_dir)
-                copy2(path, Path(dst_dir, inode), follow_symlinks=follow_symlinks)
-        except Exception:
-            logging.exception("--- Problem with copying from directory [%s] to directory[%s] with inode: '%s'",
-                              src_dir, dst_dir, inode)
-
-
-def mirror_dircmp(dir_cmp: dircmp, *, follow_symlinks: bool = False, dry: bool = False) -> None:  # noqa: C901
-    """Mirror src directory to dst directory."""
-    if dir_cmp.funny_files:
-        logging.warning("- Directory [%s] contains uncomparable files: %s", dir_cmp.left, str(dir_cmp.funny_files))
-    if dir_cmp.common_funny:
-        logging.warning("- Directory [%s] contains uncomparable inodes: %s", dir_cmp.left, str(dir_cmp.common_funny))
-
-    if dir_cmp.right_only:  # files and directory only in dst directory to remove:
-        logging.info("- From destination directory [%s] to remove inodes: %s", dir_cmp.right, str(dir_cmp.right_only))
+                skipped.append(entry.name)
+    if skipped:
+        logging.warning("--- Directory [%s] contains uncopyable inodes (special files or dangling symlinks): %s",
+                        src_dir, skipped)
+    return subdirs, futures
+
+
+def fast_copytree(src: str, dst: str, *, follow_symlinks: bool = False, executor: Executor | None = None) -> None:
+    """Copy directory tree src to dst (iterative os.scandir walk, directories are copied by copy_dir_files).
+
+    Directories are created while walking, files are copied in parallel if executor is set. Errors with single
+    files and directories are logged and skipped. Metadata of directories are copied at the end, after their
+    contents.
+    """
+    dirs, copied_dirs, futures = [(src, dst)], [], []
+    for src_dir, dst_dir in dirs:  # dirs grows while walking
+        try:
+            subdirs, dir_futures = copy_dir_files(src_dir, dst_dir, follow_symlinks=follow_symlinks, executor=executor)
+        except OSError:
+            logging.exception("--- Problem with copying directory [%s] to [%s]", src_dir, dst_dir)
+            continue
+        dirs.extend(subdirs)
+        futures.extend(dir_futures)
+        copied_dirs.append((src_dir, dst_dir))
+    for future in futures:
+        future.result()
+    for src_dir, dst_dir in reversed(copied_dirs):  # subdirectories before their parents
+        try:
+            copystat(src_dir, dst_dir)
+        except OSError:
+            logging.exception("--- Problem with copying metadata of directory [%s] to [%s]", src_dir, dst_dir)
+
+
+def copy_dir(src_dir: str, dst_dir: str, inode: str, *, follow_symlinks: bool = False,
+             executor: Executor | None = None) -> None:
+    """Copy directory tree inode from directory src_dir to directory dst_dir (files in parallel if executor is set)."""
+    path = os.path.join(src_dir, inode)
+    try:
+        logging.debug("--- Copy directory tree [%s] to [%s]", path, dst_dir)
+        fast_copytree(path, os.path.join(dst_dir, inode), follow_symlinks=follow_symlinks, executor=executor)
+    except Exception:
+        logging.exception("--- Problem with copying from directory [%s] to directory[%s] with inode: '%s'",
+                          src_dir, dst_dir, inode)
+
+
+def copy_inodes(src_dir: str, dst_dir: str, file_inodes: list[str], dir_inodes: list[str], *,  # noqa: PLR0913
+                follow_symlinks: bool = False, executor: Executor | None = None) -> None:
+    """Copy files and directories in inodes lists from directory src_dir to directory dst_dir.
+
+    Copy in parallel if executor is set (files of directory trees are submitted to executor from this thread).
+    """
+    _map = executor.map if executor else map
+    list(_map(partial(copy_file, src_dir, dst_dir, follow_symlinks=follow_symlinks), file_inodes))
+    for inode in dir_inodes:
+        copy_dir(src_dir, dst_dir, inode, follow_symlinks=follow_symlinks, executor=executor)
+
+
+def mirror_node(node: FastDirCmp, *, follow_symlinks: bool = False, dry: bool = False,
+                executor: Executor | None = None) -> None:
+    """Mirror one src directory to dst directory (without subdirectories)."""
+    if node.funny_files:
+        logging.warning("- Directory [%s] contains uncomparable files: %s", node.left, node.funny_files)
+    if node.common_funny:
+        logging.warning("- Directory [%s] contains uncomparable inodes: %s", node.left, node.common_funny)
+
+    if node.right_only:  # files and directory only in dst directory to remove:
+        logging.info("- From destination directory [%s] to remove inodes: %s", node.right, node.right_only)
         if not dry:
-            remove_inodes(dir_cmp.right, dir_cmp.right_only)
-    if dir_cmp.left_only:  # files and directory only in src directory to copy:
-        logging.info("- From source directory [%s] to copy inodes: %s", dir_cmp.left, str(dir_cmp.left_only))
+            # symlink to directory is removed as file (link), not as directory tree:
+            remove_inodes(node.right, *split_inodes(node.right_entries, node.right_only, follow_symlinks=False),
+                          executor=executor)
+    if node.left_only:  # files and directory only in src directory to copy:
+        logging.info("- From source directory [%s] to copy inodes: %s", node.left, node.left_only)
         if not dry:
-            copy_inodes(dir_cmp.left, dir_cmp.right, dir_cmp.left_only, follow_symlinks=follow_symlinks)
-    if dir_cmp.diff_files:  # different files to rewrite (copy) from src to dst:
-        logging.info("- From source directory [%s] to rewrite (copy) files: %s", dir_cmp.left, str(dir_cmp.diff_files))
+            copy_inodes(node.left, node.right,
+                        *split_inodes(node.left_entries, node.left_only, follow_symlinks=follow_symlinks),
+                        follow_symlinks=follow_symlinks, executor=executor)
+    if node.diff_files:  # different files to rewrite (copy) from src to dst:
+        logging.info("- From source directory [%s] to rewrite (copy) files: %s", node.left, node.diff_files)
         if not dry:
-            copy_inodes(dir_cmp.left, dir_cmp.right, dir_cmp.diff_files, follow_symlinks=follow_symlinks)
+            copy_inodes(node.left, node.right, node.diff_files, [], follow_symlinks=follow_symlinks, executor=executor)
+
+
+def mirror_dircmp(dir_cmp: FastDirCmp, *, follow_symlinks: bool = False, dry: bool = False,
+                  executor: Executor | None = None) -> None:
+    """Mirror src directory to dst directory.
+
+    Directory tree is walked iteratively (explicit stack), so deep nesting is not limited by recursion limit.
+    If executor is set, inodes are copied/removed in parallel and when root directory has more than
+    PARALLEL_SUBDIRS_MIN subdirectories, each subtree is mirrored in its own thread (sequentially below).
+    Subtrees without differences (not dirty) are skipped.
+    """
+    if executor and len(dir_cmp.subdirs) > PARALLEL_SUBDIRS_MIN:
+        mirror_node(dir_cmp, follow_symlinks=follow_symlinks, dry=dry, executor=executor)
+        logging.debug("- From source directory [%s] to mirror subdirectories in parallel: %s",
+                      dir_cmp.left, dir_cmp.subdirs.keys())
+        # subtrees get no executor - waiting on the same pool from its worker threads could deadlock,
+        # dirty flags are computed in threads too (compare of subtree is done by computing it)
+        futures = [executor.submit(mirror_dircmp, subdir, follow_symlinks=follow_symlinks, dry=dry)
+                   for subdir in dir_cmp.subdirs.values()]
+        for future in futures:
+            future.result()
+        return
+
+    if not dir_cmp.dirty:
+        logging.debug("- Directory tree [%s] has no differences to mirror", dir_cmp.left)
+        return
+    stack = deque([dir_cmp])
+    while stack:
+        node = stack.pop()
+        mirror_node(node, follow_symlinks=follow_symlinks, dry=dry, executor=executor)
+
+        subdirs = [subdir for subdir in node.subdirs.values() if subdir.dirty]
+        if subdirs:  # subdirectories with differences to mirror from src to dst:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):  # skip the loop when debug messages are dropped
+                logging.debug("- From source directory [%s] to mirror subdirectories: %s",
+                              node.left, [os.path.basename(subdir.left) for subdir in subdirs])
+                for subdir in subdirs:
+                    logging.debug("--- Mirror subdirectory [%s] to [%s]", subdir.left, subdir.right)
+            stack.extend(reversed(subdirs))  # reversed to keep order of subdirectories as stack pops
+
+
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "ncpfs", "afs", "9p", "ceph", "glusterfs", "fuse.sshfs"}
+
+
+def is_local_fs(path: str) -> bool:
+    """Test if path is on local filesystem (inotify does not see changes made by other clients of network fs)."""
+    path = os.path.realpath(path)
+    mount_point, fs_type = "", ""
+    with open("/proc/mounts") as mounts:
+        for line in mounts:
+            _mount_point, _fs_type = line.split()[1:3]
+            _mount_point = _mount_point.replace("\\040", " ")  # space is escaped in /proc/mounts
+            if (path == _mount_point or path.startswith(_mount_point.rstrip("/") + "/")) \
+                    and len(_mount_point) >= len(mount_point):
+                mount_point, fs_type = _mount_point, _fs_type
+    return fs_type not in NETWORK_FILESYSTEMS
+
+
+WATCH_FLAGS = (flags.CREATE | flags.DELETE | flags.MODIFY | flags.ATTRIB | flags.MOVED_FROM | flags.MOVED_TO
+               if INotify else 0)
+FULL_COMPARE_INTERVALS = 60  # with inotify, whole directories are compared every 60 intervals (repair changes in dst)
+
+
+class SrcWatcher:
+    """Watch directory tree by inotify and collect directories with changed inodes.
+
+    If any directory can not be watched (e.g. limit of watches is reached), watching is stopped (watching is False).
+    """
 
-    if dir_cmp.subdirs:  # subdirectories to mirror from src to dst:
-        logging.debug("- From source directory [%s] to mirror subdirectories: %s",
-                      dir_cmp.left, str(dir_cmp.subdirs.keys()))
-        for subdir in dir_cmp.subdirs.values():
-            logging.debug("--- Mirror subdirectory [%s] to [%s]", subdir.left, subdir.right)
-            mirror_dircmp(subdir, follow_symlinks=follow_symlinks, dry=dry)
+    def __init__(self, top: str) -> None:
+        """Add watches to all directories in top directory tree."""
+        self.inotify = INotify()
+        self.watches: dict[int, str] = {}  # watch descriptor: directory path
+        self.watching = True
+        self.add_tree(top)
+
+    def add_tree(self, top: str) -> None:
+        """Add watches to directories in top directory tree (existing watches are updated to current paths)."""
+        for dir_path, _, _ in os.walk(top):
+            try:
+                self.watches[self.inotify.add_watch(dir_path, WATCH_FLAGS)] = dir_path
+            except (FileNotFoundError, NotADirectoryError):  # directory is already removed
+                pass
+            except OSError:
+                logging.exception("- Can not watch directory [%s], watching of source directory is stopped", dir_path)
+                self.watching = False
+                return
+
+    def remove_tree(self, top: str) -> None:
+        """Remove watches of directories in top directory tree (moved out)."""
+        prefix = os.path.join(top, "")
+        for wd, dir_path in list(self.watches.items()):
+            if dir_path == top or dir_path.startswith(prefix):
+                del self.watches[wd]
+                with suppress(OSError):  # directory is already removed
+                    self.inotify.rm_watch(wd)
+
+    def changed_dirs(self, delay: float, timeout: float) -> tuple[set[str], set[str]] | None:
+        """Wait for changes at most timeout seconds, then collect them for delay seconds.
+
+        Return changed directories and created or moved in directory trees (their contents may be unknown to dst),
+        empty sets after timeout, None if events were lost or watching stopped.
+        """
+        events = self.inotify.read(timeout=int(timeout * 1000))
+        if not events:
+            return set(), set()
+        sleep(delay)
+        events += self.inotify.read(timeout=0)
+        changed, trees = set(), set()
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                logging.warning("- Inotify queue overflow, some changes were lost")
+                return None
+            dir_path = self.watches.get(event.wd)
+            if event.mask & flags.IGNORED:  # watched directory was removed
+                self.watches.pop(event.wd, None)
+            if dir_path is None:
+                continue
+            changed.add(dir_path)
+            if event.mask & flags.ISDIR and event.mask & flags.MOVED_FROM:
+                self.remove_tree(os.path.join(dir_path, event.name))
+            if event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO):
+                trees.add(os.path.join(dir_path, event.name))
+                self.add_tree(os.path.join(dir_path, event.name))
+        return (changed, trees) if self.watching else None
+
+    def close(self) -> None:
+        """Stop watching, remove all watches."""
+        self.inotify.close()
+
+
+def mirror_changed_dirs(src: str, dst: str, src_dirs: set[str], src_trees: set[str], *,  # noqa: PLR0913
+                        follow_symlinks: bool = False, dry: bool = False, executor: Executor | None = None) -> None:
+    """Mirror changed directories src_dirs (in src tree) to dst (without subdirectories, they are watched itself).
+
+    If changed directory or its counterpart in dst does not exist, the nearest existing parent is mirrored.
+    Created or moved in directory trees src_trees are mirrored whole after that (name may exist in dst, e.g. swapped
+    directory, and inodes created before the watch was added have no events).
+    """
+    rel_dirs = set()
+    for src_dir in src_dirs:
+        rel_dir = os.path.relpath(src_dir, src)
+        while rel_dir != os.curdir and not (os.path.isdir(os.path.join(src, rel_dir))
+                                            and os.path.isdir(os.path.join(dst, rel_dir))):
+            rel_dir = os.path.dirname(rel_dir) or os.curdir
+        rel_dirs.add(rel_dir)
+    for rel_dir in sorted(rel_dirs):  # parent directories first
+        dir_cmp = DirCmp(os.path.normpath(os.path.join(src, rel_dir)), os.path.normpath(os.path.join(dst, rel_dir)),
+                         top_ignore=HASH_CACHE_NAMES if rel_dir == os.curdir else ())
+        logging.debug("--- Mirror changed directory [%s] to [%s]", dir_cmp.left, dir_cmp.right)
+        mirror_node(dir_cmp, follow_symlinks=follow_symlinks, dry=dry, executor=executor)
+
+    rel_trees = []
+    for rel_dir in sorted(os.path.relpath(src_tree, src) for src_tree in src_trees):
+        if any(rel_dir.startswith(os.path.join(rel_tree, "")) for rel_tree in rel_trees):
+            continue  # mirrored with its parent tree
+        rel_trees.append(rel_dir)
+        left, right = os.path.join(src, rel_dir), os.path.join(dst, rel_dir)
+        if os.path.isdir(left) and os.path.isdir(right):  # otherwise copied or removed by mirror of its parent
+            logging.debug("--- Mirror new directory tree [%s] to [%s]", left, right)
+            mirror_dircmp(DirCmp(left, right), follow_symlinks=follow_symlinks, dry=dry, executor=executor)
 
 
 def valid_dir(_path: str) -> str:
@@ -117,9 +755,16 @@ if __name__ == "__main__":
     parser.add_argument("--dry", action="store_true", help="only compare directories, do not copy or delete files")
     parser.add_argument("--follow-symlinks", action="store_true",
                         help="follow symlinks to source when copy, if not set, default symlinks copy as link")
-    parser.add_argument("-b", "--by-content", action="store_true", help="compare files by binary content")
+    parser.add_argument("-b", "--by-content", action="store_true",
+                        help="compare files by binary content (hashes are cached in dst directory)")
     parser.add_argument("-i", "--interval", default=0, type=lambda x: abs(int(x)),
                         help="interval for periodical sync in seconds, default 0 (no periodical sync, run only once)")
+    parser.add_argument("--poll", action="store_true",
+                        help="periodically compare whole directories, if not set, default on linux with inotify_simple "
+                             "only changed directories in local src are mirrored (at most once per interval), "
+                             f"whole directories are compared every {FULL_COMPARE_INTERVALS} intervals")
+    parser.add_argument("-w", "--workers", default=(os.cpu_count() or 1) * 2, type=lambda x: abs(int(x)),
+                        help="number of threads for parallel copy/remove, default 2 * cpu count (0 - no threads)")
     parser.add_argument("-f", "--log-file", default="", help="path to log file, default empty (no log file)")
     parser.add_argument("src", type=valid_dir, help="path to existing source directory")
     parser.add_argument("dst", type=valid_dir, help="path to existing destination directory")
@@ -127,16 +772,20 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     # check for directory nesting:
-    src = Path(args.src)
-    dst = Path(args.dst)
+    src = os.path.realpath(args.src)  # symlinks resolved, so aliased directories are found too
+    dst = os.path.realpath(args.dst)
+    try:
+        common = os.path.commonpath([src, dst])
+    except ValueError:  # different drives
+        common = None
     msg = "Argument error: "
     if src == dst:
         msg += f"src [{args.src}] and dst [{args.dst}] must be different!"
         raise SystemExit(msg)
-    if src in dst.parents:
+    if common == src:
         msg += f"dst [{args.dst}] must be outside src [{args.src}], otherwise the copy will loop endlessly!"
         raise SystemExit(msg)
-    if dst in src.parents:
+    if common == dst:
         msg += f"src [{args.src}] must be outside dst [{args.dst}], otherwise src will be broken!"
         raise SystemExit(msg)
 
@@ -154,10 +803,15 @@ if __name__ == "__main__":
     # set comparison type:
     if args.by_content:
         DirCmp = DirCmpByContents
-        logging.info("Compare files by binary content (shallow=False)")
+        DirCmp.hash_cache = HashCache(":memory:" if args.dry else str(Path(args.dst, HASH_CACHE_NAME)))
+        if args.workers:  # own pool - hashing is waited for from threads of copy/remove executor
+            DirCmp.hash_executor = ThreadPoolExecutor(max_workers=min(args.workers, HASH_WORKERS))
+        logging.info("Compare files by binary content (hashes %s)", HASH_NAME)
     else:
-        DirCmp = dircmp
+        DirCmp = FastDirCmp
         logging.info("Shallow compare (default - compare files only by name, size, mtime)")
+    if args.interval:
+        FastDirCmp.listing_cache = ListingCache()
 
     # mirror:
     if args.dry:
@@ -165,20 +819,53 @@ if __name__ == "__main__":
     else:
         logging.info("Start mirroring directories:")
 
+    _executor = ThreadPoolExecutor(max_workers=args.workers) if args.workers else None
     try:
+        watcher = None
+        if args.interval and not args.poll and INotify and platform == "linux" and is_local_fs(args.src):
+            logging.info("Watch source directory for changes (inotify), mirror at most once per interval, "
+                         "compare whole directories every %s intervals", FULL_COMPARE_INTERVALS)
+            watcher = SrcWatcher(args.src)  # before first compare, so no change is missed
         while True:
             logging.debug("Start compare.")
-            _dir_cmp = DirCmp(args.src, args.dst, ignore=[])  # compare directories
-            mirror_dircmp(_dir_cmp, follow_symlinks=args.follow_symlinks, dry=args.dry)
-            if args.interval:
-                logging.debug("Pause to next compare.")
-                sleep(args.interval)
-            else:
+            if FastDirCmp.listing_cache:
+                FastDirCmp.listing_cache.next_sync()
+            _dir_cmp = DirCmp(args.src, args.dst, top_ignore=HASH_CACHE_NAMES)  # compare directories
+            mirror_dircmp(_dir_cmp, follow_symlinks=args.follow_symlinks, dry=args.dry, executor=_executor)
+            if DirCmpByContents.hash_cache:
+                DirCmpByContents.hash_cache.prune_unseen()  # all files were compared
+                DirCmpByContents.hash_cache.commit()
+            if not args.interval:
                 logging.info("End of mirroring directories.")
                 exit(0)
+            if watcher and not watcher.watching:  # changes in not watched directories would be missed
+                logging.warning("Watching of source directory failed, whole directories are compared every interval")
+                watcher.close()
+                watcher = None
+            if watcher:
+                logging.debug("Wait for changes in source directory.")
+                full_compare_at = monotonic() + args.interval * FULL_COMPARE_INTERVALS
+                while (timeout := full_compare_at - monotonic()) > 0:
+                    changes = watcher.changed_dirs(args.interval, timeout)
+                    if changes is None:  # events lost - full compare
+                        break
+                    if changes[0]:
+                        mirror_changed_dirs(args.src, args.dst, *changes, follow_symlinks=args.follow_symlinks,
+                                            dry=args.dry, executor=_executor)
+                        if DirCmpByContents.hash_cache:
+                            DirCmpByContents.hash_cache.commit()
+                        logging.debug("Wait for changes in source directory.")
+            else:
+                logging.debug("Pause to next compare.")
+                sleep(args.interval)
     except KeyboardInterrupt:
         logging.warning("End of mirroring directories by keyboard interrupt (Ctrl-C).")
         exit(0)
     except Exception:
         logging.exception("Exception when mirroring directories.")
         exit(1)
+    finally:
+        if _executor:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        if DirCmpByContents.hash_executor:
+            DirCmpByContents.hash_executor.shutdown(wait=False, cancel_futures=True)
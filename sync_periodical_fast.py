@@ -0,0 +1,181 @@
+"""Hot per-file helpers of sync_periodical (scan, stat, compare and hash files).
+
+Module is strictly typed pure python, so it can be compiled by mypyc for speed:
+
+    mypyc sync_periodical_fast.py
+
+Compiled extension module is imported instead of this file when it exists, otherwise this file is used.
+"""
+from __future__ import annotations
+
+import ctypes
+import errno
+import os
+import struct
+from contextlib import suppress
+from stat import S_IFDIR, S_IFMT, S_IFREG
+from sys import platform
+from typing import TYPE_CHECKING, Any, Final
+
+if TYPE_CHECKING:
+    from io import BufferedReader
+
+try:  # optional dependency - fast non-cryptographic hash
+    from xxhash import xxh3_128 as hash_new  # type: ignore[import-not-found,unused-ignore]
+except ImportError:
+    from hashlib import blake2b as hash_new  # type: ignore[assignment,unused-ignore]
+
+HASH_NAME: Final = hash_new().name  # stored with hash, so cache made by other algorithm is not used
+HASH_CHUNK: Final = 1 << 20  # 1 MiB
+
+AT_FDCWD: Final = -100
+AT_STATX_DONT_SYNC: Final = 0x4000  # do not sync metadata with server (network filesystems), use cached attributes
+STATX_TYPE: Final = 0x1
+STATX_MTIME: Final = 0x40
+STATX_CTIME: Final = 0x80
+STATX_INO: Final = 0x100
+STATX_SIZE: Final = 0x200
+STATX_MASK: Final = STATX_TYPE | STATX_SIZE | STATX_MTIME | STATX_CTIME | STATX_INO
+
+
+STATX_SIZEOF: Final = 256  # sizeof(struct statx) from linux/stat.h
+STATX_LAYOUT: Final = struct.Struct("=28xH2xQQ48xqI4xqI")  # stx_mode, stx_ino, stx_size, stx_ctime, stx_mtime
+
+
+libc: Any = ctypes.CDLL(None, use_errno=True) if os.name == "posix" else None
+libc_memcmp: Any = getattr(libc, "memcmp", None)
+if libc_memcmp:
+    libc_memcmp.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+    libc_memcmp.restype = ctypes.c_int
+libc_statx: Any = getattr(libc, "statx", None) if platform == "linux" else None
+if libc_statx:  # glibc >= 2.28
+    libc_statx.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_void_p]
+    libc_statx.restype = ctypes.c_int
+
+
+def stat_signature(path: str | bytes) -> tuple[int, int, int, int, int]:
+    """Return signature (file type, size, mtime_ns, ctime_ns, inode) of path (following symlinks).
+
+    On linux statx(AT_STATX_DONT_SYNC) asks only for needed attributes, otherwise os.stat is used.
+    Bytes path is not encoded again.
+    """
+    global libc_statx  # noqa: PLW0603
+    if libc_statx:
+        buf = ctypes.create_string_buffer(STATX_SIZEOF)
+        if not libc_statx(AT_FDCWD, os.fsencode(path), AT_STATX_DONT_SYNC, STATX_MASK, buf):
+            mode, ino, size, ctime_sec, ctime_nsec, mtime_sec, mtime_nsec = STATX_LAYOUT.unpack_from(buf)
+            return (S_IFMT(mode), size, mtime_sec * 1_000_000_000 + mtime_nsec,
+                    ctime_sec * 1_000_000_000 + ctime_nsec, ino)
+        _errno = ctypes.get_errno()
+        if _errno != errno.ENOSYS:
+            raise OSError(_errno, os.strerror(_errno), path)
+        libc_statx = None  # kernel without statx (or blocked by seccomp)
+    st = os.stat(path)
+    return S_IFMT(st.st_mode), st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino
+
+
+FADVISE: Final = hasattr(os, "posix_fadvise")  # not on macOS and windows
+PREFETCH_MAX: Final = 8 << 20  # 8 MiB, maximum of file start read ahead before compare
+
+
+def prefetch(path: str | bytes, size: int) -> None:
+    """Ask kernel to read ahead start of file (asynchronously), so reading overlaps with other work."""
+    if FADVISE:
+        with suppress(OSError):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, min(size, PREFETCH_MAX), os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+
+def drop_cache(fd: int) -> None:
+    """Ask kernel to drop cached pages of file read once, so big syncs do not thrash page cache."""
+    if FADVISE:
+        with suppress(OSError):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+CMP_READ_MIN: Final = 1 << 16  # 64 KiB, smaller files are compared by one read
+CMP_CHUNK: Final = 1 << 22  # 4 MiB, size of read buffers of compared files
+
+
+def same_buffers(a_buf: bytearray, b_buf: bytearray, length: int) -> bool:
+    """Compare first length bytes of two buffers (by libc memcmp if available)."""
+    if not libc_memcmp:
+        with memoryview(a_buf) as a_view, memoryview(b_buf) as b_view:
+            return a_view[:length] == b_view[:length]
+    a_arr: Any = (ctypes.c_char * len(a_buf)).from_buffer(a_buf)
+    b_arr: Any = (ctypes.c_char * len(b_buf)).from_buffer(b_buf)
+    try:
+        return bool(libc_memcmp(a_arr, b_arr, length) == 0)
+    finally:
+        del a_arr, b_arr  # release exported buffers
+
+
+def same_contents(a_path: str | bytes, b_path: str | bytes, size: int) -> bool:
+    """Compare contents of two files with the same size (read in CMP_CHUNK slices)."""
+    with open(a_path, "rb") as a_file, open(b_path, "rb") as b_file:
+        try:
+            return same_files(a_file, b_file, size)
+        finally:
+            drop_cache(a_file.fileno())
+            drop_cache(b_file.fileno())
+
+
+def same_files(a_file: BufferedReader, b_file: BufferedReader, size: int) -> bool:
+    """Compare contents of two open files with the same size (read to buffers, compared by same_buffers).
+
+    Files are read, not mapped, so file truncated by other process during compare is only different (no SIGBUS).
+    """
+    if size < CMP_READ_MIN:
+        return a_file.read() == b_file.read()
+    length = min(size, CMP_CHUNK)
+    a_buf, b_buf = bytearray(length), bytearray(length)
+    while a_read := a_file.readinto(a_buf):
+        if b_file.readinto(b_buf) != a_read or not same_buffers(a_buf, b_buf, a_read):
+            return False
+    return not b_file.read(1)
+
+
+def cmp_signatures(a_sig: tuple[int, int, int, int, int], b_sig: tuple[int, int, int, int, int]) -> bool | None:
+    """Compare two files by signatures (as shallow filecmp.cmp), None if contents have to be compared (equal sizes).
+
+    Only file type, size and mtime_ns are compared (ctime and inode of copy differ).
+    """
+    if a_sig[:3] == b_sig[:3]:
+        return a_sig[0] == S_IFREG
+    if a_sig[0] != S_IFREG or b_sig[0] != S_IFREG or a_sig[1] != b_sig[1]:
+        return False
+    return None
+
+
+def hash_file(path: str) -> str:
+    """Return hash of file contents (file is read to one reused buffer of HASH_CHUNK, not mapped - no SIGBUS)."""
+    file_hash = hash_new()
+    buf = bytearray(HASH_CHUNK)
+    with open(path, "rb", buffering=0) as file, memoryview(buf) as view:
+        while size := file.readinto(buf):
+            file_hash.update(view[:size])
+        drop_cache(file.fileno())
+    return f"{HASH_NAME}:{file_hash.hexdigest()}"
+
+
+def scan_dir(directory: str, skip: frozenset[str]) -> dict[str, os.DirEntry[str]]:
+    """Return entries of directory by names (one os.scandir, names in skip set are left out)."""
+    with os.scandir(directory) as entries:
+        if not skip:
+            return {entry.name: entry for entry in entries}
+        return {entry.name: entry for entry in entries if entry.name not in skip}
+
+
+def entry_type(entry: os.DirEntry[str]) -> int:
+    """Return S_IFDIR, S_IFREG or 0 (other or not stat-able) of directory entry (following symlinks)."""
+    try:
+        if entry.is_dir():  # file type is known from directory listing, stat only for symlinks
+            return S_IFDIR
+        if entry.is_file():
+            return S_IFREG
+    except OSError:
+        pass
+    return 0